@@ -1,176 +1,513 @@
+import atexit
+import collections
+import concurrent.futures
+import datetime
+import functools
 import logging
 import os
+import random
 import re
 import threading
 import time
 import urllib.parse
 from pathlib import Path
 
-import bs4
-import markdown
+import orjson
 import requests
+import requests_cache
+import urllib3
 
-from exceptions import CitationCaptureException
+from exceptions import (
+    CitationBrokenLinkException,
+    CitationCaptureException,
+    CitationException,
+    CitationLookupException,
+)
 
 logger = logging.getLogger(__name__)
 
-host_denylist = [
+# Membership tests are atomic and need no lock; only additions are made under host_denylist_lock.
+host_denylist: set[str] = {
     "www.fastcompany.com",
     "www.techpowerup.com",
     "discord.com",
     "twitter.com",
     "x.com",
-]
+}
 host_denylist_lock = threading.Lock()
 
+# Citation lookups from every page share one pool of workers, so that the number of requests in
+# flight stays bounded no matter how many pages are being processed at the same time.
+_MAX_WORKERS = 16
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=_MAX_WORKERS, thread_name_prefix="citations"
+)
+
+# Requests that fail in a way that may be temporary are retried up to _MAX_RETRIES times, waiting
+# up to _MAX_BACKOFF seconds between attempts.
+_MAX_RETRIES = 6
+_MAX_BACKOFF = 30
+
+# Capture jobs that are still pending after this many seconds are given up on, so a job that
+# never leaves the queue cannot hold up the run forever. Pending jobs are checked after 1 second,
+# then twice as long after each check, up to _MAX_POLL_INTERVAL seconds.
+_CAPTURE_TIMEOUT = 600
+_MAX_POLL_INTERVAL = 16
+
+# Cached availability lookups that found no archive are refreshed after this long, since the page
+# may have been archived since. Lookups that found one are kept for a day.
+_MISS_CACHE_TTL = datetime.timedelta(hours=1)
+
+# (connect, read) timeouts for requests to archive.org, so a stalled connection cannot hold a worker
+# indefinitely.
+_DEFAULT_TIMEOUT = (5, 30)
+
+# Status codes servers use to refuse HEAD requests, rather than to report a broken link.
+_HEAD_UNSUPPORTED_STATUSES = frozenset({403, 405, 501})
+
+# Save Page Now endpoint and the headers that authenticate with it. These are only sent to
+# archive.org, never with requests to cited sites, so they are not set on the shared session.
+_SAVE_URL = "https://web.archive.org/save"
+_ARCHIVE_ACCESS_KEY = os.getenv("ARCHIVE_ACCESS_KEY")
+_ARCHIVE_SECRET_KEY = os.getenv("ARCHIVE_SECRET_KEY")
+_ARCHIVE_HEADERS = {
+    "Accept": "application/json",
+    "authorization": f"LOW {_ARCHIVE_ACCESS_KEY}:{_ARCHIVE_SECRET_KEY}",
+}
+
+# Capture requests are spread out to at most _SAVE_RATE_LIMIT per _SAVE_RATE_PERIOD seconds across
+# all workers, so a large batch stays under the Save Page Now rate limit instead of bursting past
+# it and then backing off.
+_SAVE_RATE_LIMIT = 15
+_SAVE_RATE_PERIOD = 60
+_save_times: collections.deque[float] = collections.deque()
+_save_times_lock = threading.Lock()
+
+# Links to archived copies start with one of these.
+_ARCHIVE_PREFIXES = ("https://web.archive.org/", "http://web.archive.org/")
+# Every footnote definition starts with this, so pages without it need not be searched.
+_FOOTNOTE_PREFIX = "[^"
+# Matches the YAML frontmatter at the start of a page.
+_FRONTMATTER_RE = re.compile(r"^---\n.*?\n---\n", re.DOTALL)
+# Matches a fenced code block, from its opening fence to its closing fence or the end of the page.
+_FENCE_RE = re.compile(
+    r"^ {0,3}(?P<fence>(?P<char>[`~])(?P=char){2,}).*"
+    r"(?:\n(?:.*\n)*? {0,3}(?P=fence)(?P=char)*[ \t]*$|(?:\n.*)*)",
+    re.MULTILINE,
+)
+# Matches a footnote definition, including any indented lines that continue it.
+_FOOTNOTE_DEF_RE = re.compile(r"^\[\^[^\]]+\]:.*(?:\n(?!\[\^|\S).*)*", re.MULTILINE)
+# Matches the target of an http(s) autolink (<url>), inline link ([text](url)) or HTML link
+# (<a href="url">), or the text and label of a reference link ([text][label], [label][] or
+# [label]). Like CommonMark, the target of an inline link may contain parentheses as long as they
+# are balanced, as in many Wikipedia URLs, allowing one level of nesting.
+_LINK_RE = re.compile(
+    r"<(https?://[^\s>]+)>"
+    r"|\]\((https?://(?:[^\s()]|\([^\s()]*\))+)"
+    r"|\[([^\[\]]+)\](?:\[([^\[\]]*)\])?(?![(:])"
+    r"|(?i:<a\s[^>]*?\bhref\s*=\s*[\"'](https?://[^\"'\s]+))"
+)
+# Matches a link reference definition ([label]: url), which reference links point to. Footnote
+# definitions look alike, but their labels start with a caret.
+_LINK_REF_DEF_RE = re.compile(
+    r"^ {0,3}\[(?!\^)([^\[\]]+)\]:[ \t]*<?(https?://[^\s>]+)>?", re.MULTILINE
+)
+
+# Shared across all threads so that connections to archive.org and cited hosts are kept alive
+# between requests instead of being re-established for every call. Responses are cached on disk, so
+# that re-runs do not repeat lookups whose answers rarely change. Save Page Now is never cached.
+# Broken links are cached too, so they are not probed again on every run.
+_session = requests_cache.CachedSession(
+    str(Path(os.getenv("WIKIBOT_CACHE_DIR", ".")) / "wikibot-http-cache"),
+    backend="sqlite",
+    expire_after=3600,
+    allowable_codes=(200, 404, 410),
+    urls_expire_after={
+        "archive.org/wayback/available": 86400,
+        "web.archive.org/save": requests_cache.DO_NOT_CACHE,
+    },
+    cache_control=True,
+)
+_adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+# Availability lookups are retried by urllib3 on connection errors, rate limits and gateway errors,
+# honoring Retry-After. Cited sites are not retried: one failed probe is enough to report a broken
+# link, and their Retry-After headers could stall a worker for hours.
+_archive_retry = urllib3.util.Retry(
+    total=_MAX_RETRIES,
+    backoff_factor=0.5,
+    backoff_max=_MAX_BACKOFF,
+    backoff_jitter=1.0,
+    status_forcelist=(429, 502, 503, 504),
+    raise_on_status=False,
+)
+_archive_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=32, pool_maxsize=32, max_retries=_archive_retry
+)
+_session.mount("https://archive.org", _archive_adapter)
+# Save Page Now requests already retry connection errors and timeouts themselves, so urllib3 only
+# retries their rate limits and gateway errors, instead of multiplying the attempts.
+_save_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=32, pool_maxsize=32, max_retries=_archive_retry.new(connect=0, read=0)
+)
+_session.mount("https://web.archive.org", _save_adapter)
+
+
+def close() -> None:
+    """Shuts down the shared worker pool and HTTP session once every page has been processed.
+
+    Registered with atexit, since both are shared by every run in the process.
 
-def create_archive(url: str) -> str:
-    """Captures a new archive of the provided URL on the Archive.org Wayback Machine and returns
-    the URL to it.
+    :rtype: None
+    """
+    _executor.shutdown()
+    _session.close()
 
-    If a ConnectionError is encountered, retries infinitely (until the recursion limit) every 10
-    seconds.
 
-    Uses the Save Page Now API, documented at
-    https://docs.google.com/document/d/1Nsv52MvSjbLb2PCpHlat0gkzw0EvtSgpKHu4mk0MnrA
+atexit.register(close)
+
+
+def _json(req: requests.Response) -> dict:
+    """Parses the JSON body of a response with orjson, which is considerably faster than the
+    standard library parser used by requests.
+
+    :param requests.Response req: The response to parse.
+    :rtype: dict
+    :return: The parsed JSON body.
+    :raises: requests.JSONDecodeError
+    """
+    try:
+        return orjson.loads(req.content)
+    except orjson.JSONDecodeError as error:
+        raise requests.JSONDecodeError(error.msg, error.doc, error.pos)
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Calculates how long to wait before retrying a request, using exponential backoff with full
+    jitter so that concurrent workers do not retry in lockstep.
+
+    :param int attempt: The number of attempts that have already failed.
+    :rtype: float
+    :return: The number of seconds to wait.
+    """
+    return min(_MAX_BACKOFF, 2**attempt) * random.random()
+
+
+def _wait_for_save_slot() -> None:
+    """Blocks until another capture request can be sent without exceeding _SAVE_RATE_LIMIT.
+
+    :rtype: None
+    """
+    while True:
+        with _save_times_lock:
+            now = time.monotonic()
+            while _save_times and now - _save_times[0] >= _SAVE_RATE_PERIOD:
+                _save_times.popleft()
+            if len(_save_times) < _SAVE_RATE_LIMIT:
+                _save_times.append(now)
+                return
+            delay = _SAVE_RATE_PERIOD - (now - _save_times[0])
+        time.sleep(delay)
+
+
+def _submit_capture(url: str) -> str:
+    """Queues a new capture of the provided URL on the Archive.org Wayback Machine.
+
+    If a ConnectionError or timeout is encountered, or too many capture sessions are active,
+    retries up to _MAX_RETRIES times with exponential backoff, sending at most _MAX_RETRIES
+    requests in all. Once the Wayback Machine reports
+    that a host has had too many captures today, further captures of it are skipped.
 
     :param str url: The URL of the page to archive.
     :rtype: str
-    :return: An archive.org URL to a newly-captured archive.
+    :return: The Save Page Now job ID of the queued capture.
     :raises: exceptions.CitationCaptureException
     """
-    headers = {
-        "Accept": "application/json",
-        "authorization": f"LOW {os.getenv("ARCHIVE_ACCESS_KEY")}:{os.getenv("ARCHIVE_SECRET_KEY")}",
-    }
+    # Save Page Now rejects every request without keys, so do not spend attempts finding that out.
+    if not (_ARCHIVE_ACCESS_KEY and _ARCHIVE_SECRET_KEY):
+        raise CitationCaptureException(
+            "ARCHIVE_ACCESS_KEY and ARCHIVE_SECRET_KEY must be set to create captures."
+        )
+
     data = {"url": url, "skip_first_archive": 1}
+    host = urllib.parse.urlparse(url).hostname
 
-    # Tell Archive.org to queue a crawl and get the Job ID of it.
-    logger.debug(f"Attempting to queue Wayback Machine capture of {url}.")
-    try:
-        req = requests.post("https://web.archive.org/save", data=data, headers=headers)
-        response = req.json()
-    except requests.ConnectionError as error:
-        logger.info(
-            f"Encountered a Connection Error while creating capture job for {url}. This usually indicates a rate limit. Retrying in 10 seconds."
-        )
-        logger.debug(f"ConnectionError for capture of {url}: {error}")
-        time.sleep(10)
-        return create_archive(url)
-    except requests.RequestException as error:
-        raise CitationCaptureException(f"Encountered an error while creating capture job: {error}")
-
-    logger.debug(f"Capture Request Response: {response}")
-
-    job_id = response.get("job_id")
-    if job_id is None:
-        if response.get("status") == "error":
-            error_code = response.get("status_ext")
-            if error_code == "error:too-many-daily-captures-host":
-                parsed_url = urllib.parse.urlparse(url)
-                host = parsed_url.hostname
-                logger.debug(f"Adding {host} to denylist.")
-                with host_denylist_lock:
-                    if host not in host_denylist:
-                        host_denylist.append(host)
-                raise CitationCaptureException(
-                    f"The Wayback Machine has created too many captures of {host} today. Added to denylist for this run."
+    delay = 0
+    for attempt in range(_MAX_RETRIES):
+        time.sleep(delay)
+
+        # Tell Archive.org to queue a crawl and get the Job ID of it.
+        logger.debug(f"Attempting to queue Wayback Machine capture of {url}.")
+        _wait_for_save_slot()
+
+        # Another capture may have hit the host's daily limit while this one was waiting.
+        if host in host_denylist:
+            raise CitationCaptureException(
+                f"The Wayback Machine has created too many captures of {host} today. Skipping."
+            )
+
+        try:
+            req = _session.post(
+                _SAVE_URL, data=data, headers=_ARCHIVE_HEADERS, timeout=_DEFAULT_TIMEOUT
+            )
+            response = _json(req)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            logger.debug(f"{type(error).__name__} for capture of {url}: {error}")
+            if attempt == _MAX_RETRIES - 1:
+                break
+            delay = _backoff_delay(attempt)
+            logger.info(
+                f"Encountered a Connection Error while creating capture job for {url}. This usually indicates a rate limit. Retrying in {delay:.1f} seconds."
+            )
+            continue
+        except requests.RequestException as error:
+            raise CitationCaptureException(
+                f"Encountered an error while creating capture job: {error}"
+            )
+
+        logger.debug(f"Capture Request Response: {response}")
+
+        job_id = response.get("job_id")
+        if job_id is not None:
+            return job_id
+
+        if response.get("status") != "error":
+            raise CitationCaptureException(f"Bad response from Wayback Machine: {response}")
+
+        error_code = response.get("status_ext")
+        if error_code == "error:too-many-daily-captures-host":
+            logger.debug(f"Adding {host} to denylist.")
+            with host_denylist_lock:
+                host_denylist.add(host)
+            raise CitationCaptureException(
+                f"The Wayback Machine has created too many captures of {host} today. Skipping its other captures for this run."
+            )
+        elif error_code == "error:user-session-limit":
+            if attempt == _MAX_RETRIES - 1:
+                break
+            delay = _backoff_delay(attempt)
+            logger.info(
+                f"Rate limited while attempting to create archive of {url} because there are too many active capture sessions. Retrying in {delay:.1f} seconds."
+            )
+        else:
+            raise CitationCaptureException(
+                f"Wayback Machine reported {error_code} with the following message: {response.get("message")}"
+            )
+
+    raise CitationCaptureException(f"Gave up creating capture job after {_MAX_RETRIES} attempts.")
+
+
+def _poll_captures(jobs: dict[str, str]) -> dict[str, str | CitationCaptureException]:
+    """Waits for a batch of Save Page Now capture jobs to complete.
+
+    Every pending job is checked once per polling interval, so the whole batch shares a single
+    wait instead of each job waiting separately. The interval starts at 1 second, so fast captures
+    return quickly, and doubles after every check, up to _MAX_POLL_INTERVAL seconds. If a
+    ConnectionError or timeout is encountered while checking a job, it is checked again during the
+    next interval, up to _MAX_RETRIES times. Jobs still pending after _CAPTURE_TIMEOUT seconds
+    are given up on, and so is any job whose status could not be read. The deadline is also
+    checked between jobs, so a run of slow status checks can only overrun it by one request.
+
+    :param dict[str, str] jobs: A mapping of job IDs to the URLs being captured.
+    :rtype: dict[str, str | CitationCaptureException]
+    :return: A mapping of each URL to an archive.org URL to its new archive, or to the exception
+        describing why the capture failed.
+    """
+    results = {}
+    pending = dict(jobs)
+    connection_errors = dict.fromkeys(jobs, 0)
+    deadline = time.monotonic() + _CAPTURE_TIMEOUT
+    interval = 1
+    while pending:
+        if time.monotonic() >= deadline:
+            for url in pending.values():
+                results[url] = CitationCaptureException(
+                    f"Gave up waiting for capture job after {_CAPTURE_TIMEOUT} seconds."
+                )
+            break
+
+        time.sleep(interval)
+        interval = min(interval * 2, _MAX_POLL_INTERVAL)
+        for job_id, url in list(pending.items()):
+            if time.monotonic() >= deadline:
+                break
+            logger.debug(f"Checking status of capture job {job_id} for url {url}")
+            try:
+                req = _session.get(
+                    f"{_SAVE_URL}/status/{job_id}",
+                    headers=_ARCHIVE_HEADERS,
+                    timeout=_DEFAULT_TIMEOUT,
                 )
-            elif error_code == "error:user-session-limit":
-                logger.info(
-                    f"Rate limited while attempting to create archive of {url} because there are too many active capture sessions. Retrying in 5 seconds."
+                req.raise_for_status()
+                response = _json(req)
+                status = response["status"]
+            except (requests.ConnectionError, requests.Timeout) as error:
+                logger.debug(f"{type(error).__name__} for status check of {url}: {error}")
+                connection_errors[job_id] += 1
+                if connection_errors[job_id] >= _MAX_RETRIES:
+                    results[url] = CitationCaptureException(
+                        f"Gave up checking job status after {_MAX_RETRIES} connection errors."
+                    )
+                    del pending[job_id]
+                else:
+                    logger.info(
+                        f"Encountered a Connection Error while checking capture job for {url}. This usually indicates a rate limit. Retrying on the next check."
+                    )
+                continue
+            except requests.RequestException as error:
+                results[url] = CitationCaptureException(
+                    f"Encountered an error while checking job status: {error}"
+                )
+                del pending[job_id]
+                continue
+            except (KeyError, TypeError):
+                results[url] = CitationCaptureException(
+                    f"Wayback Machine returned an unexpected job status: {req.text}"
                 )
-                time.sleep(5)
-                return create_archive(url)
+                del pending[job_id]
+                continue
+
+            logger.debug(f"Status Check Response {response}")
+            if status == "pending":
+                continue
+
+            del pending[job_id]
+            if status == "success" and "timestamp" not in response:
+                results[url] = CitationCaptureException(
+                    f"Wayback Machine returned an unexpected job status: {req.text}"
+                )
+            elif status == "success":
+                logger.info(f"Successfuly captured archive of {url}")
+                results[url] = f"https://web.archive.org/web/{response["timestamp"]}/{url}"
             else:
-                raise CitationCaptureException(
-                    f"Wayback Machine reported {error_code} with the following message: {response.get("message")}"
+                results[url] = CitationCaptureException(
+                    f"Wayback Machine reported {response.get("status_ext")}"
                 )
-        else:
-            raise CitationCaptureException(f"Bad response from Wayback Machine: {response}")
 
-    # Check the job status until completed.
-    status = "pending"
-    while status == "pending":
-        logger.debug(f"Checking status of capture job {job_id} for url {url}")
-        time.sleep(5)
+    return results
+
+
+def create_archive(url: str) -> str:
+    """Captures a new archive of the provided URL on the Archive.org Wayback Machine and returns
+    the URL to it.
+
+    Uses the Save Page Now API, documented at
+    https://docs.google.com/document/d/1Nsv52MvSjbLb2PCpHlat0gkzw0EvtSgpKHu4mk0MnrA
+
+    :param str url: The URL of the page to archive.
+    :rtype: str
+    :return: An archive.org URL to a newly-captured archive.
+    :raises: exceptions.CitationCaptureException
+    """
+    job_id = _submit_capture(url)
+    result = _poll_captures({job_id: url})[url]
+    if isinstance(result, CitationCaptureException):
+        raise result
+    return result
+
+
+@functools.lru_cache(maxsize=4096)
+def _lookup_archive(url: str) -> str | None:
+    """Looks up the most recent archive of the provided URL with the Wayback Machine availability
+    API.
+
+    Results are cached until clear_caches is called. Failed lookups raise instead of returning, so
+    they are not cached. A miss read from the disk cache is looked up again once it is older than
+    _MISS_CACHE_TTL.
+
+    :param str url: The URL of the page to archive.
+    :rtype: str | None
+    :return: None if the page has not been archived. Otherwise, an archive.org URL.
+    :raises: exceptions.CitationLookupException
+    """
+    for force_refresh in (False, True):
         try:
-            req = requests.get(f"https://web.archive.org/save/status/{job_id}", headers=headers)
-        except requests.ConnectionError as error:
-            logger.info(
-                f"Encountered a Connection Error while creating capture job for {url}. This usually indicates a rate limit. Retrying in 10 seconds."
+            req = _session.get(
+                "https://archive.org/wayback/available",
+                params={"url": url},
+                timeout=_DEFAULT_TIMEOUT,
+                force_refresh=force_refresh,
             )
-            logger.debug(f"ConnectionError for status check of {url}: {error}")
-            time.sleep(10)
-            return create_archive(url)
+            if not req.ok:
+                raise CitationLookupException(
+                    f"Request returned HTTP status code {req.status_code}"
+                )
+            snapshots = _json(req)["archived_snapshots"]
         except requests.RequestException as error:
-            raise CitationCaptureException(
-                f"Encountered an error while checking job status: {error}"
-            )
+            raise CitationLookupException(str(error))
+        except (KeyError, TypeError):
+            raise CitationLookupException(f"Unexpected response from availability API: {req.text}")
 
-        response = req.json()
-        logger.debug(f"Status Check Response {response}")
-        status = response["status"]
+        # Only ask again if this is a miss that has been in the disk cache for too long.
+        cached_miss = req.from_cache and not snapshots.get("closest")
+        if (
+            not cached_miss
+            or req.created_at > datetime.datetime.now(datetime.UTC) - _MISS_CACHE_TTL
+        ):
+            break
 
-    if status == "success":
-        logger.info(f"Successfuly captured archive of {url}")
-        return f"https://web.archive.org/web/{response["timestamp"]}/{url}"
-    elif status == "error":
-        raise CitationCaptureException(f"Wayback Machine reported {response["status_ext"]}")
+    closest = snapshots.get("closest")
+    if closest and closest["available"] is True:
+        logger.info(f"Found existing archive link for {url}")
+        return closest["url"]
 
 
 def find_archive(url: str) -> str | None:
     """Locates the most recent archive of the provided URL from the Wayback Machine.
 
-    If the rate limit kicks in, retries infinitely (until the recursion limit) after the suggested
-    amount of time (or every 10 seconds if no Retry-After header is provided.)
+    Rate limits, gateway errors and connection errors are retried by the session up to
+    _MAX_RETRIES times, honoring Retry-After. Successful lookups are cached until clear_caches is
+    called.
 
     :param str url: The URL of the page to archive.
     :rtype: str | None
     :return: None if an archive could not be located. Otherwise, an archive.org URL.
     """
     try:
-        req = requests.get(f"https://archive.org/wayback/available?url={url}")
-        if req.ok:
-            snapshots = req.json()["archived_snapshots"]
-            closest = snapshots.get("closest")
-            if closest and closest["available"] is True:
-                archive_url = closest["url"]
-                logger.info(f"Found existing archive link for {url}")
-                return archive_url
-            else:
-                return
-        # If the API rate limits, wait for the suggested amount of time.
-        elif req.status_code == 429:
-            wait_time = req.headers.get("Retry-After")
-            # If no time is suggested, wait for 10 seconds.
-            if wait_time is None:
-                wait_time = 10
-            logger.info(
-                f"Rate limited while attempting to locate archive for {url}. Waiting for {wait_time} seconds."
-            )
-            time.sleep(wait_time)
-            return find_archive(url)
-        else:
-            logger.error(
-                f"Failed to search for archived copy of {url}: Request returned HTTP status code {req.status_code}"
-            )
-    except requests.RequestException as error:
+        return _lookup_archive(url)
+    except CitationLookupException as error:
         logger.error(f"Failed to search for archived copy of {url}: {error}")
-        return
+    except Exception:
+        logger.exception(f"Unexpected error while searching for archived copy of {url}")
+
+
+@functools.lru_cache(maxsize=4096)
+def _probe_url(url: str) -> tuple[bool, int]:
+    """Fetches the response headers of a given URL.
+
+    A HEAD request is tried first, falling back to a streamed GET request for servers that refuse
+    HEAD requests. Responses are cached until clear_caches is called. Failed requests raise instead
+    of returning, so they are not cached, and a network error is not mistaken for a broken link on
+    a later run.
+
+    :param str url: The URL to check.
+    :rtype: tuple[bool, int]
+    :returns: True if the server answered with a success status, otherwise False, and the status
+        code it answered with.
+    :raises: requests.RequestException
+    """
+    req = _session.head(url, allow_redirects=True, timeout=10)
+    if req.status_code in _HEAD_UNSUPPORTED_STATUSES:
+        # The body is never read, so it must not be cached either.
+        req = _session.get(url, stream=True, timeout=10, headers={"Cache-Control": "no-store"})
+        req.close()
+    return (req.ok, req.status_code)
 
 
 def check_url_reachable(url: str) -> tuple[bool, int]:
     """Checks whether a given URL is reachable.
 
+    Only the response headers are fetched, with _probe_url.
+
     :param str url: The URL to check.
-    :rtype: bool
-    :returns: True if the URL is reachable. Otherwise False.
+    :rtype: tuple[bool, int]
+    :returns: True if the URL is reachable, otherwise False, and the HTTP status code of the
+        response, or -1 if the request failed.
     """
     try:
-        req = requests.get(url, timeout=10)
-        link_ok = req.ok
-        status_code = req.status_code
+        link_ok, status_code = _probe_url(url)
         if link_ok is False:
             logger.debug(f"Link {url} is broken. Server responded {status_code}")
     except requests.RequestException as error:
@@ -181,46 +518,175 @@ def check_url_reachable(url: str) -> tuple[bool, int]:
     return (link_ok, status_code)
 
 
-def check_citations(page: Path) -> None:
-    """Checks that every footnote on a given page has a working primary link and an archive link.
+def clear_caches() -> None:
+    """Forgets the archive lookups and link checks made so far in this process.
 
-    - If a footnote has an archive link already, does nothing.
-    - If a footnote has no archive link, attempts to add a link to an existing archive.
-    - If a footnote has no archive link and no existing archive link is available, but the primary link is functional,
-    creates and adds a link to a new archive snapshot.
-    - If a footnote has no archive link, the primary link is broken, and there is no archive of the
-    page, logs a warning.
+    Call this at the start of each run in a long-running process, so that a miss read from the disk
+    cache is refreshed after _MISS_CACHE_TTL, as it is in a new process.
 
-    :param Path page: a Path object pointing to the page that needs processing.
     :rtype: None
     """
+    _lookup_archive.cache_clear()
+    _probe_url.cache_clear()
 
-    # Read markdown, strip frontmatter, convert to html for parsing.
-    contents = page.read_text()
-    contents = re.sub(r"(?s)^---\n.*?\n---\n", "", contents, count=1)
-    contents = markdown.markdown(contents, extensions=["fenced_code", "footnotes"])
 
-    # Get the list of footnotes.
-    doc = bs4.BeautifulSoup(contents, features="html.parser")
-    footnotes = doc.find("div", class_="footnote")
+def find_archives(urls: list[str]) -> dict[str, str | None]:
+    """Locates the most recent archive of each of the provided URLs from the Wayback Machine.
+
+    The availability API only answers for one URL per request, so the lookups are run
+    concurrently on the shared pool of workers instead, all reusing the same kept-alive
+    connections to archive.org.
+
+    :param list[str] urls: The URLs of the pages to look up.
+    :rtype: dict[str, str | None]
+    :return: A mapping of each URL to an archive.org URL, or to None if an archive could not be
+        located.
+    """
+    archives = dict(zip(urls, _executor.map(find_archive, urls)))
+    for url, archive_url in archives.items():
+        if archive_url is not None:
+            logger.debug(f"Found archive link {archive_url} for primary url {url}")
+    return archives
+
+
+def _check_capturable(url: str) -> None:
+    """Checks that a URL without an archive is still reachable, so that a new archive can be
+    created.
+
+    :param str url: The primary URL of a citation.
+    :rtype: None
+    :raises: exceptions.CitationBrokenLinkException
+    """
+    link_ok, status_code = check_url_reachable(url)
+    if link_ok is False:
+        status_msg = ""
+        if status_code != -1:
+            status_msg = f" (HTTP Status Code: {status_code})"
+        raise CitationBrokenLinkException(f"{url}{status_msg}")
+
+    logger.debug(f"Failed to locate archive of {url}. Attempting to create.")
+
+
+def _check_host_capturable(urls: list[str]) -> dict[str, CitationException | None]:
+    """Checks a list of URLs on the same host with _check_capturable, one after another.
+
+    :param list[str] urls: The primary URLs of citations, all on the same host.
+    :rtype: dict[str, CitationException | None]
+    :return: A mapping of each URL to the exception raised for it, or to None if it is reachable.
+    """
+    results = {}
+    for url in urls:
+        try:
+            results[url] = _check_capturable(url)
+        except CitationBrokenLinkException as error:
+            results[url] = error
+        except Exception as error:
+            logger.exception(f"Unexpected error while checking {url}")
+            results[url] = CitationException(f"Unexpected error while checking link: {error!r}")
+    return results
+
+
+def _split_fences(contents: str) -> list[str]:
+    """Splits the text of a page around its fenced code blocks, which are shown as they are written
+    and never contain footnotes.
+
+    :param str contents: The text of the page.
+    :rtype: list[str]
+    :return: The pieces of the page, in order, alternating between text outside of fenced code
+        blocks and a fenced code block. The first and last pieces are outside of any block.
+    """
+    if "```" not in contents and "~~~" not in contents:
+        return [contents]
+
+    pieces = []
+    start = 0
+    for match in _FENCE_RE.finditer(contents):
+        pieces.append(contents[start : match.start()])
+        pieces.append(match.group())
+        start = match.end()
+    pieces.append(contents[start:])
+    return pieces
+
+
+def _link_references(contents: str) -> dict[str, str]:
+    """Finds the link reference definitions on a page.
+
+    :param str contents: The text of the page, outside of fenced code blocks.
+    :rtype: dict[str, str]
+    :return: A mapping of each normalized label to its URL. As in CommonMark, the first
+        definition of a label is the one used.
+    """
+    references = {}
+    for label, url in _LINK_REF_DEF_RE.findall(contents):
+        references.setdefault(_normalize_label(label), url)
+    return references
+
+
+def _normalize_label(label: str) -> str:
+    """Normalizes a link label the way CommonMark matches them, ignoring case and collapsing runs
+    of whitespace.
+
+    :param str label: The label as written.
+    :rtype: str
+    :return: The normalized label.
+    """
+    return " ".join(label.split()).casefold()
+
+
+def extract_urls(page: Path) -> list[str]:
+    """Finds the primary link of every footnote on a given page that has no archive link.
+
+    Footnotes without any links, and footnotes citing a denylisted host, are logged and skipped.
+
+    :param Path page: a Path object pointing to the page that needs processing.
+    :rtype: list[str]
+    :return: The primary links, in the order they are cited, without duplicates.
+    """
+    # Read markdown and strip frontmatter.
+    contents = page.read_text(encoding="utf-8")
+    contents = _FRONTMATTER_RE.sub("", contents, count=1)
+    contents = "".join(_split_fences(contents)[::2])
+
+    # Get the list of footnote definitions, skipping the search on pages that cannot have any.
+    footnotes = []
+    if _FOOTNOTE_PREFIX in contents:
+        footnotes = _FOOTNOTE_DEF_RE.findall(contents)
 
     # Do nothing if there are no footnotes.
     if not footnotes:
         logger.debug(f"No footnotes found in {page.name}")
-        return
-
-    # Loop over footnotes.
-    for note in footnotes.find_all("li"):
-        links = note.find_all(
-            "a", href=lambda href: href and href.startswith(("http://", "https://"))
-        )
+        return []
+
+    # Collect the primary links of footnotes that are missing an archive link. Reference links
+    # are resolved through the definitions on the page, and skipped if their label is undefined.
+    references = _link_references(contents)
+    urls = []
+    for note in footnotes:
+        links = []
+        for autolink, inline, text, label, href in _LINK_RE.findall(note):
+            if text:
+                link = references.get(_normalize_label(label or text))
+            else:
+                link = autolink or inline or href
+            if link:
+                links.append(link)
+
+        # If there is an archive link, the footnote is fine. The substring test is cheaper than
+        # checking every link, so it runs first, but it would also match footnotes that only
+        # mention web.archive.org in their text or in the query string of another link. An
+        # archive link by reference is defined elsewhere on the page, so it is not skipped then.
+        if ("web.archive.org" in note or references) and any(
+            link.startswith(_ARCHIVE_PREFIXES) for link in links
+        ):
+            logger.debug(f"Found archive link in footnote in {page.name}")
+            continue
 
         # Make sure there is at least one link.
         if len(links) == 0:
             logger.warning(f"Footnote in {page.name} has no links. Skipping.")
             continue
 
-        url = links[0].get("href")
+        url = links[0]
         logger.debug(f"Checking citation {url} in {page.name}")
 
         parsed_url = urllib.parse.urlparse(url)
@@ -229,64 +695,163 @@ def check_citations(page: Path) -> None:
             logger.info(f"Skipping footnote to {url} in {page.name} because {host} is denylisted.")
             continue
 
-        # Check if there is an archive link.
-        archive_link_present = False
-        for link in links:
-            link_url = link.get("href")
-            if link_url.startswith("https://web.archive.org") or link_url.startswith(
-                "http://web.archive.org"
-            ):
-                archive_link_present = True  # If there is an archive link, the footnote is fine.
-                logger.debug(f"Found archive link in citation {url}")
-                break
-        if archive_link_present is True:
-            continue
-
         logger.debug(f"No archive link found in citation {url}. Attempting fix.")
+        # The same source may be cited by several footnotes, but only needs to be resolved once.
+        if url not in urls:
+            urls.append(url)
 
-        # Try to find an existing archive.
-        logger.debug(f"Attempting to locate archive of {url}.")
-        archive_url = find_archive(url)
-        if archive_url is not None:
-            logger.debug(f"Found archive link {archive_url} for primary url {url}")
+    return urls
+
+
+def resolve_archives(urls: list[str]) -> dict[str, str | CitationException]:
+    """Locates an existing archive of each of the provided URLs, or creates one if there is none
+    and the URL is still reachable.
+
+    Archives are resolved concurrently, on a pool of workers shared with every other caller, so
+    URLs cited by several pages should be passed in once.
 
-        # If no archive is available and the primary link is not broken, create a new archive.
+    :param list[str] urls: The primary URLs of citations.
+    :rtype: dict[str, str | CitationException]
+    :return: A mapping of each URL to an archive.org URL, or to the exception describing why no
+        archive could be located or created. An unexpected error only affects the URL it was
+        raised for.
+    """
+    # Look up existing archives for every url at once, then check that the ones without an archive
+    # are still reachable. Probes spend nearly all of their time waiting on the cited site, so they
+    # also run concurrently, but urls on the same host are checked by the same worker, one after
+    # another, so that they reuse its kept-alive connection.
+    archives = {}
+    hosts = collections.defaultdict(list)
+    for url, archive_url in find_archives(urls).items():
         if archive_url is None:
-            link_ok, status_code = check_url_reachable(url)
-            if link_ok is True:
-                logger.debug(f"Failed to locate archive of {url}. Attempting to create.")
-                try:
-                    archive_url = create_archive(url)
-                except CitationCaptureException as error:
-                    logger.warning(
-                        f"Footnote in {page.name} contains link to {url}, for which no archive is available and none could be created: {error}"
-                    )
-                    continue
+            hosts[urllib.parse.urlparse(url).hostname].append(url)
+        else:
+            archives[url] = archive_url
+
+    to_capture = []
+    for results in _executor.map(_check_host_capturable, hosts.values()):
+        for url, error in results.items():
+            if error is None:
+                to_capture.append(url)
             else:
-                status_msg = ""
-                if status_code != -1:
-                    status_msg = f" (HTTP Status Code: {status_code})"
-                logger.warning(
-                    f"Footnote in {page.name} contains broken link to {url}{status_msg}. No archived copy could be located."
-                )
-                continue
+                archives[url] = error
+
+    # Queue captures of every page that has no archive yet, then wait on them as one batch.
+    jobs = {}
+    results = {_executor.submit(_submit_capture, url): url for url in to_capture}
+    for thread in concurrent.futures.as_completed(results):
+        url = results[thread]
+        try:
+            jobs[thread.result()] = url
+        except CitationCaptureException as error:
+            archives[url] = error
+        except Exception as error:
+            logger.exception(f"Unexpected error while creating capture job for {url}")
+            archives[url] = CitationCaptureException(f"Unexpected error: {error!r}")
+
+    try:
+        archives.update(_poll_captures(jobs))
+    except Exception as error:
+        logger.exception("Unexpected error while waiting for capture jobs")
+        for url in jobs.values():
+            archives[url] = CitationCaptureException(f"Unexpected error: {error!r}")
+    return archives
+
+
+def rewrite_page(page: Path, archives: dict[str, str | CitationException]) -> bool:
+    """Adds archive links to the footnotes on a given page, and logs a warning for every citation
+    that could not be archived.
+
+    :param Path page: a Path object pointing to the page that needs processing.
+    :param dict[str, str | CitationException] archives: The results of resolve_archives for the
+        primary links on the page.
+    :rtype: bool
+    :return: True if the page was changed, False otherwise.
+    """
+    archive_map = {}
+    for url, result in archives.items():
+        if isinstance(result, CitationBrokenLinkException):
+            logger.warning(
+                f"Footnote in {page.name} contains broken link to {result}. No archived copy could be located."
+            )
+        elif isinstance(result, CitationException):
+            logger.warning(
+                f"Footnote in {page.name} contains link to {url}, for which no archive is available and none could be created: {result}"
+            )
+        else:
+            archive_map[url] = result
+
+    if not archive_map:
+        return False
+
+    # Put the archive urls on the page in a single substitution over its text, writing it only
+    # once. The pattern matches a footnote line up to any of the resolved urls, or a reference to
+    # one of them, then the rest of the line without its trailing whitespace, so the link can be
+    # appended in its place.
+    contents = page.read_text(encoding="utf-8")
+    written = set()
+
+    def add_archive_link(match: re.Match) -> str:
+        url = match.group(2) or labels[_normalize_label(match.group(3))]
+        written.add(url)
+        return f"{match.group(1)} [Archived]({archive_map[url]}) "
+
+    # A plain substring test is much cheaper than the pattern, so only urls that are still on the
+    # page are put into it, and it is not compiled at all if there are none.
+    cited = [url for url in archive_map if url in contents]
+    if cited:
+        # Footnotes in fenced code blocks are only examples, so the blocks are left as they are.
+        pieces = _split_fences(contents)
+        labels = {
+            label: url
+            for label, url in _link_references("".join(pieces[::2])).items()
+            if url in archive_map
+        }
+        targets = (
+            r"(?<=[\s<\[\(\"'])(" + "|".join(re.escape(url) for url in cited) + r")(?=[\s>\]\)\"'])"
+        )
+        if labels:
+            # Labels match regardless of case and of how whitespace is written, as they do in
+            # CommonMark.
+            targets += (
+                r"|\[(?i:("
+                + "|".join(r"\s+".join(map(re.escape, label.split())) for label in labels)
+                + r"))\]"
+            )
+        footnote_pattern = re.compile(
+            "^(" + re.escape(_FOOTNOTE_PREFIX) + r".*?(?:" + targets + r").*?)[ \t]*$",
+            re.MULTILINE,
+        )
+        pieces[::2] = [footnote_pattern.sub(add_archive_link, piece) for piece in pieces[::2]]
+        contents = "".join(pieces)
+    if written:
+        page.write_text(contents, encoding="utf-8", newline="\n")
 
-        # Put archive_url on the page.
-        logger.debug(f"Writing archive url {archive_url} to {page.name}")
-        with page.open("r") as file:
-            lines = file.readlines()
-        modified_lines = []
-        wrote = False
-        for line in lines:
-            if line.startswith("[^") and re.search(
-                rf"(?<=[\s<\[\(]){re.escape(url)}(?=[\s>\]\)])", line
-            ):
-                line = f"{line.rstrip()} [Archived]({archive_url}) \n"
-                wrote = True
-            modified_lines.append(line)
-        with page.open("w") as file:
-            file.writelines(modified_lines)
-        if wrote is False:
+    for url, archive_url in archive_map.items():
+        if url not in written:
             logger.error(f"Failed to write {archive_url} to {page.name} for primary link {url}")
         else:
             logger.debug(f"Wrote {archive_url} to {page.name} for primary link {url}")
+
+    return bool(written)
+
+
+def check_citations(page: Path) -> None:
+    """Checks that every footnote on a given page has a working primary link and an archive link.
+
+    - If a footnote has an archive link already, does nothing.
+    - If a footnote has no archive link, attempts to add a link to an existing archive.
+    - If a footnote has no archive link and no existing archive link is available, but the primary link is functional,
+    creates and adds a link to a new archive snapshot.
+    - If a footnote has no archive link, the primary link is broken, and there is no archive of the
+    page, logs a warning.
+
+    When checking many pages, call extract_urls, resolve_archives and rewrite_page directly
+    instead, so that links cited by several pages are only resolved once.
+
+    :param Path page: a Path object pointing to the page that needs processing.
+    :rtype: None
+    """
+    urls = extract_urls(page)
+    if urls:
+        rewrite_page(page, resolve_archives(urls))
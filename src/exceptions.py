@@ -14,3 +14,15 @@ class CitationCaptureException(CitationException):
     """Raised when Wikibot's citations module fails to capture an archive."""
 
     pass
+
+
+class CitationLookupException(CitationException):
+    """Raised when Wikibot's citations module fails to search for an existing archive."""
+
+    pass
+
+
+class CitationBrokenLinkException(CitationException):
+    """Raised when a citation's primary link is broken and no archive of it could be located."""
+
+    pass
@@ -1,60 +1,357 @@
+import argparse
+import atexit
 import concurrent.futures
+import itertools
 import logging
+import logging.handlers
 import os
 import sys
-import traceback
+import time
+from collections.abc import Callable, Iterable, Iterator
 from pathlib import Path
 
-import citations
+from exceptions import CitationBrokenLinkException, CitationException
 
 logger = logging.getLogger(__name__)
 
+_PROD = bool(os.environ.get("PRODUCTION"))
+_WORKSPACE = "/github/workspace" if _PROD else "./test_wiki"
+# Its modification time records when the last incremental run started.
+_STAMP = os.path.join(_WORKSPACE, ".wikibot.stamp")
 
-def process_page(page: Path) -> None:
-    logger.info(f"Processing {page.name}")
-    citations.check_citations(page)
-    logger.info(f"Finished processing {page.name}")
+# Pages are parsed and rewritten by one pool of worker processes, created on first use and kept
+# for the lifetime of the interpreter, so repeated runs do not pay to start new workers. There is one
+# worker for each CPU this process may run on, or a single worker if that cannot be determined.
+_MAX_WORKERS = os.process_cpu_count() or 1
+_executor: concurrent.futures.ProcessPoolExecutor | None = None
 
+_logging_configured = False
+
+# Directories that never contain wiki pages, and are not searched for them. Hidden directories, such
+# as .git, are skipped as well.
+_SKIP = frozenset({"node_modules", "__pycache__"})
+
+
+def find_pages(root: str) -> Iterator[os.DirEntry]:
+    """Finds every markdown file under a directory.
+
+    Walks the tree with os.scandir, which reports whether each entry is a directory from the data
+    it already read for the listing, instead of making a stat call for every entry like Path.glob.
+    Hidden directories and the directories in _SKIP are not descended into. The directory entries
+    are returned as they are, since they cache the result of stat for any later use.
+
+    :param str root: The directory to search.
+    :rtype: Iterator[os.DirEntry]
+    :return: The directory entries of the markdown files.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith(".") and entry.name not in _SKIP:
+                        stack.append(entry.path)
+                elif entry.name.endswith(".md") and entry.is_file():
+                    yield entry
+
+
+def find_citations(page: str) -> list[str] | None:
+    """Finds the citations on a page that need an archive, logging any exception raised instead of
+    ignoring it.
+
+    :param str page: The path of the page to check.
+    :rtype: list[str] | None
+    :return: The result of citations.extract_urls, or None if it raised an exception.
+    """
+    import citations
+
+    try:
+        return citations.extract_urls(Path(page))
+    except Exception:
+        logger.exception("Failed to check citations in %s", os.path.basename(page))
+
+
+def process_page(page: str, archives: dict[str, str | CitationException]) -> bool | None:
+    """Adds archive links to a page, logging any exception raised instead of ignoring it.
+
+    :param str page: The path of the page to process.
+    :param dict[str, str | CitationException] archives: The results of resolve_archives for the
+        citations on the page.
+    :rtype: bool | None
+    :return: The result of citations.rewrite_page, or None if it raised an exception.
+    """
+    import citations
+
+    try:
+        return citations.rewrite_page(Path(page), archives)
+    except Exception:
+        logger.exception("Failed to add archive links to %s", os.path.basename(page))
+
+
+class _MarkdownFormatter(logging.Formatter):
+    """A log formatter that puts tracebacks in a fenced code block, so that they are readable when
+    the log is posted to a pull request."""
+
+    def formatException(self, ei) -> str:
+        return f"```\n{super().formatException(ei)}\n```"
+
+
+def _init_worker() -> None:
+    """Prepares a worker process to log only warnings and errors.
+
+    Workers inherit the parent's handlers, so the warnings they log still reach stdout and the PR
+    log. Progress messages are logged by the parent as results come back, so workers do not spend
+    time creating records that would only repeat them.
+
+    Records the parent had buffered when the worker was forked are dropped, since the parent
+    writes them itself. Workers are forked before the parent imports the citations module, so
+    each worker imports it here, with its own HTTP cache connection, rather than on its first page.
+
+    :rtype: None
+    """
+    import citations  # noqa: F401
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    for handler in root.handlers:
+        if isinstance(handler, logging.handlers.MemoryHandler):
+            handler.buffer.clear()
+
+
+def _get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the shared pool of worker processes, creating it on first use.
+
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=_MAX_WORKERS, initializer=_init_worker
+        )
+        atexit.register(_executor.shutdown)
+    return _executor
+
+
+def _run_batch[T](fn: Callable[..., T], batch: tuple[tuple, ...]) -> list[T]:
+    """Calls a function with each set of arguments in a batch, in a worker process.
+
+    :param Callable fn: The function to call.
+    :param tuple[tuple, ...] batch: The arguments of each call.
+    :rtype: list[T]
+    :return: The result of each call, in order.
+    """
+    return [fn(*args) for args in batch]
+
+
+def _map_bounded[T](
+    executor: concurrent.futures.Executor,
+    fn: Callable[..., T],
+    calls: Iterable[tuple],
+    chunksize: int,
+) -> Iterator[tuple[tuple, T]]:
+    """Calls a function with each set of arguments on a pool of workers, in batches of chunksize
+    calls.
+
+    Unlike Executor.map, which submits every call up front, at most two batches per worker are in
+    flight at any time, and the arguments of later batches are not read until a batch finishes.
+    Results are returned as soon as their batch finishes, so a slow page does not hold back the
+    pages after it.
+
+    :param concurrent.futures.Executor executor: The pool of workers to run the calls on.
+    :param Callable fn: The function to call. It must not raise, since an exception would end the
+        whole batch.
+    :param Iterable[tuple] calls: The arguments of each call.
+    :param int chunksize: The number of calls to send to a worker at once.
+    :rtype: Iterator[tuple[tuple, T]]
+    :return: The arguments and result of each call, in the order they finish.
+    """
+    batches = itertools.batched(calls, chunksize)
+    inflight = {
+        executor.submit(_run_batch, fn, batch): batch
+        for batch in itertools.islice(batches, 2 * _MAX_WORKERS)
+    }
+    while inflight:
+        done, _ = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            yield from zip(inflight.pop(future), future.result())
+            for batch in itertools.islice(batches, 1):
+                inflight[executor.submit(_run_batch, fn, batch)] = batch
+
+
+def _configure_logging() -> None:
+    """Sets up logging to stdout, and to the PR log in production, the first time it is called.
+
+    Later calls do nothing, so repeated runs reuse the same handlers instead of opening the PR log
+    again.
+
+    :rtype: None
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
 
-def main() -> None:
     handlers = []
-    if os.environ.get("PRODUCTION"):
-        pr_handler = logging.FileHandler("/github/workspace/pr.txt")
+    if _PROD:
+        pr_handler = logging.FileHandler(os.path.join(_WORKSPACE, "pr.txt"))
         pr_handler.setLevel(logging.WARNING)
-        pr_handler.setFormatter(logging.Formatter("- %(message)s"))
+        pr_handler.setFormatter(_MarkdownFormatter("- %(message)s"))
         handlers.append(pr_handler)
 
     stdout_handler = logging.StreamHandler(sys.stdout)
     stdout_handler.setLevel(logging.INFO)
-    stdout_handler.setFormatter(logging.Formatter("%(name)s | %(levelname)s: %(message)s"))
-    handlers.append(stdout_handler)
+    stdout_handler.setFormatter(_MarkdownFormatter("%(name)s | %(levelname)s: %(message)s"))
+    # Progress messages are written to stdout in batches, at the end of each phase of a run or
+    # once 500 have built up, instead of one write per page. Warnings and errors logged by this
+    # process are written straight away, along with everything buffered before them. Those logged
+    # by workers are written by the workers, and do not flush this buffer.
+    buffered_handler = logging.handlers.MemoryHandler(
+        capacity=500, flushLevel=logging.WARNING, target=stdout_handler
+    )
+    buffered_handler.setLevel(logging.INFO)
+    handlers.append(buffered_handler)
+
+    # No handler shows anything below INFO, so debug records are not created in the first place.
+    logging.basicConfig(level=logging.INFO, handlers=handlers)
+
+
+def _flush_logs() -> None:
+    """Writes out the progress messages buffered so far.
+
+    :rtype: None
+    """
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
 
-    logging.basicConfig(level=logging.DEBUG, handlers=handlers)
+def check_pages(pages: list[str]) -> tuple[bool, bool]:
+    """Checks the citations on a list of pages, adding archive links where they are missing.
+
+    :param list[str] pages: The paths of the pages to check.
+    :rtype: tuple[bool, bool]
+    :return: Whether any page was changed, and whether every page was checked and every citation
+        on it resolved to an archive or to a broken link.
+    """
+    # Apply each check to every page. Parsing and rewriting pages is CPU-bound, so both run in
+    # separate processes. On Linux the pool forks all of its workers when the first page is
+    # submitted, and reuses them for every later phase and every later run. This process only
+    # imports citations after that, so the workers are not forked with its open HTTP cache or any
+    # of the threads used for network requests.
+    executor = _get_executor()
+    # Send pages to the workers in batches, so that the cost of passing each task between
+    # processes is shared by several pages. Each worker still gets about four batches, so the
+    # load stays balanced when some pages take longer than others.
+    chunksize = max(1, len(pages) // (_MAX_WORKERS * 4))
+
+    # Collect the citations that need an archive from every page. Results arrive in the order
+    # they finish, so they are put back in size order for the rewrite.
+    found = {
+        page: urls
+        for (page,), urls in _map_bounded(
+            executor, find_citations, ((page,) for page in pages), chunksize
+        )
+    }
+    page_urls = {page: found[page] for page in pages if found[page] is not None}
+    _flush_logs()
+
+    # Resolve each url once, however many pages cite it. Answers remembered from an earlier run in
+    # this process are dropped first, so that misses older than the disk cache allows are refreshed.
+    import citations
+
+    citations.clear_caches()
+    urls = list(dict.fromkeys(url for urls in page_urls.values() for url in urls))
+    archives = citations.resolve_archives(urls)
+    # A broken link stays broken on the next run, but a lookup or capture that failed may not.
+    complete = len(page_urls) == len(pages) and not any(
+        isinstance(archive, CitationException)
+        and not isinstance(archive, CitationBrokenLinkException)
+        for archive in archives.values()
+    )
+    _flush_logs()
+
+    # Add the archive links to every page. The archives for each page are only gathered when its
+    # batch is about to be sent.
+    page_archives = (
+        (page, {url: archives[url] for url in urls}) for page, urls in page_urls.items()
+    )
+    files_changed = False
+    for (page, _), changed in _map_bounded(executor, process_page, page_archives, chunksize):
+        if changed is None:
+            complete = False
+        else:
+            logger.info("Finished processing %s", os.path.basename(page))
+            files_changed = files_changed or changed
+    _flush_logs()
+
+    return files_changed, complete
+
+
+def main(incremental: bool = False) -> None:
+    """Checks the citations on every page in the workspace.
+
+    :param bool incremental: Only check pages modified since the last incremental run started.
+    :rtype: None
+    """
+    started = time.time()
+    _configure_logging()
 
     # Get all markdown files from workspace.
-    if os.environ.get("PRODUCTION"):
-        workspace = "/github/workspace"
+    if _PROD:
         logger.debug("Using production workspace")
     else:
-        workspace = "./test_wiki"
         logger.debug("Using development workspace")
 
-    repo = Path(workspace)
-    pages = list(repo.glob("**/*.md"))
+    # A page that can be reached by more than one path, through a symlink, is only checked once, so
+    # that two workers never rewrite the same file. Pages are told apart by device and inode, which
+    # come from the same cached stat results used below.
+    unique = {}
+    for entry in find_pages(_WORKSPACE):
+        stat = entry.stat()
+        unique.setdefault((stat.st_dev, stat.st_ino), entry)
+
+    # Start with the largest pages, so that a large page found last does not keep one worker busy
+    # long after the others have finished. Pages are passed to workers as plain str paths, which
+    # are cheaper to send between processes than Path objects.
+    entries = sorted(unique.values(), key=lambda entry: entry.stat().st_size, reverse=True)
+
+    # Pages that have not been modified since the last incremental run have already been checked.
+    # Their modification times come from the same cached stat results as their sizes.
+    since = 0.0
+    if incremental:
+        try:
+            since = os.stat(_STAMP).st_mtime
+        except FileNotFoundError:
+            logger.info("No previous incremental run found. Checking every page.")
+    pages = [entry.path for entry in entries if entry.stat().st_mtime > since]
+
+    # Importing citations opens the HTTP cache and sets up its workers, which a run without pages
+    # to check does not need.
+    files_changed, complete = check_pages(pages) if pages else (False, True)
+    logger.debug("Files changed: %s", files_changed)
+
+    # Actions reads step outputs from the file named by GITHUB_OUTPUT, not from the variable.
+    github_output = os.environ.get("GITHUB_OUTPUT")
+    if github_output:
+        with open(github_output, "a", encoding="utf-8") as file:
+            file.write(f"files_changed={str(files_changed).lower()}\n")
 
-    # Apply each check to every page.
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = {executor.submit(process_page, page): page for page in pages}
-        # Get and log any exceptions with their tracebacks instead of ignoring them.
-        for thread in concurrent.futures.as_completed(results):
-            exception = thread.exception()
-            if exception:
-                tb = traceback.format_exception(exception)
-                tb_string = ""
-                for line in tb:
-                    tb_string += line
-                logger.error(f"\n```\n{tb_string}\n```")
+    # Record when this run started, rather than when it finished, so that pages edited while it
+    # was running are checked next time. If any page failed or any citation could not be resolved,
+    # the stamp is left where it was, so that those pages are checked again next time.
+    if incremental and complete:
+        Path(_STAMP).touch()
+        os.utime(_STAMP, (started, started))
+    elif incremental:
+        logger.info("Some citations could not be resolved. They will be checked again next run.")
+    _flush_logs()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Automations for maintaining Framewiki.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only check pages modified since the last incremental run",
+    )
+    args = parser.parse_args()
+    main(incremental=args.incremental)